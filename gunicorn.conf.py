@@ -0,0 +1,15 @@
+# Loaded by gunicorn from the working directory. Times every worker from
+# the fork to being ready to accept requests; with --preload the app was
+# built once in the master, so this is what each worker costs to start
+import time
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.time()
+
+
+def post_worker_init(worker):
+    import manage
+    seconds = round(time.time() - worker.forked_at, 6)
+    manage.worker_stats['startup_seconds'] = seconds
+    worker.log.info('Worker %s started in %.1f ms', worker.pid, seconds * 1000)
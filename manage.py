@@ -1,35 +1,56 @@
+# The utils modules read their settings from the environment when they
+# are imported, so .env has to be loaded first
+from dotenv import load_dotenv
+load_dotenv('.env')
+
 from flask import (
-    Flask, render_template,
+    Flask, Blueprint,
+    render_template,
     redirect, request,
     flash, session,
-    jsonify
+    jsonify, g,
+    send_file, abort,
+    current_app
 )
 
 from utils.forms import (
     LoginForm, SignUpForm,
     AddNoteForm, AddTagForm,
-    ChangeEmailForm, ChangePasswordForm
+    ChangeEmailForm, ChangePasswordForm,
+    AddAttachmentForm
 )
 
 from flask_restful import Resource, Api, reqparse
-from utils.decorators import login_required
+from utils.decorators import login_required, rate_limit
 from flask_pagedown import PageDown
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask import Markup
 import utils.functions as functions
+import utils.ratelimit as ratelimit
+import utils.backup as backup
+import utils.query_plans as query_plans
+import utils.attachments as attachments
+import utils.cache as cache
+import utils.tag_filter as tag_filter
 import datetime
 import markdown
+import click
+import json
+import time
+import sys
 import os
 
-from dotenv import load_dotenv
-load_dotenv('.env')
-
-app = Flask(__name__)
-api = Api(app)
-pagedown = PageDown(app)
+bp = Blueprint('notes', __name__)
+api = Api(bp)
+pagedown = PageDown()
 parser = reqparse.RequestParser()
-app.secret_key = os.getenv('SECRET_KEY')
 
-@app.route('/')
+# Startup and first request timings of this worker process: the time
+# to build the app, to start the worker, and to serve its first request
+worker_stats = {}
+
+
+@bp.route('/')
 def home_page():
     '''
         App for hompage
@@ -43,7 +64,7 @@ def home_page():
         return render_template('homepage.html')
 
 
-@app.route('/profile/')
+@bp.route('/profile/')
 @login_required
 def profile():
     '''
@@ -51,21 +72,37 @@ def profile():
     '''
     if request.method == 'GET':
         notes = functions.get_data_using_user_id(session['id'])
-        tags = []
-        if notes:
-            for note in notes:
-                tags_list = functions.get_tag_using_note_id(note[0])
-                temp_list = []
-                if tags_list:
-                    for tag in tags_list:
-                        temp = functions.get_data_using_tag_id(tag)
-                        if temp is not None:
-                            temp_list.append(temp[0])
-                tags.append(', '.join(temp_list))
+        tags = get_tag_names(notes)
         return render_template('profile.html',username=session['username'],notes=notes,tags=tags)
 
 
-@app.route('/login/', methods=('GET', 'POST'))
+def get_tag_names(notes):
+    '''
+        Returns the comma separated tag names of each of the user's notes,
+        from the shared cache when the user's notes and tags are unchanged
+    '''
+    if not notes:
+        return []
+
+    def compute():
+        names = {}
+        for note in notes:
+            tags_list = functions.get_tag_using_note_id(note[0])
+            temp_list = []
+            if tags_list:
+                for tag in tags_list:
+                    temp = functions.get_data_using_tag_id(tag)
+                    if temp is not None:
+                        temp_list.append(temp[0])
+            names[str(note[0])] = ', '.join(temp_list)
+        return names
+
+    names = cache.cached('tags:%s' % session['id'], compute, session['id'])
+    return [names.get(str(note[0]), '') for note in notes]
+
+
+@bp.route('/login/', methods=('GET', 'POST'))
+@rate_limit('login', rate=0.2, capacity=10, methods=('POST', ))
 def login():
     '''
         App for creating Login page
@@ -85,7 +122,7 @@ def login():
     return render_template('login.html', form=form)
 
 
-@app.route('/signup/', methods=('GET', 'POST'))
+@bp.route('/signup/', methods=('GET', 'POST'))
 def signup():
     '''
         App for registering new user
@@ -107,7 +144,7 @@ def signup():
     return render_template('signup.html', form=form)
 
 
-@app.route("/logout/")
+@bp.route("/logout/")
 def logout():
     '''
         App for logging out user
@@ -117,7 +154,7 @@ def logout():
     return login()
 
 
-@app.route("/notes/add/", methods=['GET', 'POST'])
+@bp.route("/notes/add/", methods=['GET', 'POST'])
 @login_required
 def add_note():
     '''
@@ -145,17 +182,92 @@ def add_note():
     return render_template('add_note.html', form=form, username=session['username'])
 
 
-@app.route("/notes/<id>/")
+@bp.route("/notes/<id>/")
 @login_required
 def view_note(id):
     '''
         App for viewing a specific note
     '''
-    notes = functions.get_data_using_id(id)
-    return render_template('view_note.html', notes=notes, username=session['username'])
+    def render_note_body():
+        notes = functions.get_data_using_id(id)
+        if notes:
+            return render_template('note_body.html', notes=notes)
 
+    note_body = cache.cached('note:%s' % id, render_note_body, session['id'], id)
+    return render_template(
+        'view_note.html',
+        note_body=note_body,
+        id=id,
+        attachments=functions.get_attachments_using_note_id(id),
+        form=AddAttachmentForm(),
+        username=session['username']
+    )
 
-@app.route("/notes/edit/<note_id>/", methods=['GET', 'POST'])
+
+@bp.route("/notes/<note_id>/attachments/", methods=['POST'])
+@login_required
+def add_attachment(note_id):
+    '''
+        App for uploading a file and attaching it to a note
+    '''
+    notes = functions.get_data_using_id(note_id)
+    if not notes or notes[0][7] != session['id']:
+        abort(404)
+    form = AddAttachmentForm()
+    if form.validate_on_submit():
+        upload = form.attachment.data
+        digest, size = attachments.store(upload.stream)
+        functions.add_attachment(note_id, session['id'], digest, upload.filename, upload.mimetype)
+    else:
+        for message in form.attachment.errors:
+            flash(message)
+    return redirect('/notes/%s/' % note_id)
+
+
+@bp.route("/attachments/<attachment_id>/")
+@login_required
+def view_attachment(attachment_id):
+    '''
+        App for downloading an attachment. The content hash is the ETag,
+        and Range requests are answered from the stored file
+    '''
+    attachment = functions.get_attachment(attachment_id, session['id'])
+    if attachment is None:
+        abort(404)
+    attachment_id, note_id, digest, filename, content_type, size = attachment
+    try:
+        response = send_file(
+            attachments.blob_path(digest),
+            mimetype=content_type or 'application/octet-stream',
+            as_attachment=True,
+            attachment_filename=filename or digest,
+            add_etags=False,
+            conditional=False
+        )
+    except (IOError, OSError):
+        # The blob is gone, e.g. collected before a restore brought its row back
+        current_app.logger.warning('Blob %s of attachment %s is missing', digest, attachment_id)
+        abort(404)
+    response.set_etag(digest)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+@bp.route("/attachments/delete/<attachment_id>/")
+@login_required
+def delete_attachment(attachment_id):
+    '''
+        App for removing an attachment from its note
+    '''
+    attachment = functions.get_attachment(attachment_id, session['id'])
+    if attachment is None:
+        abort(404)
+    functions.delete_attachment_using_id(attachment_id, session['id'])
+    return redirect('/notes/%s/' % attachment[1])
+
+
+@bp.route("/notes/edit/<note_id>/", methods=['GET', 'POST'])
 @login_required
 def edit_note(note_id):
     '''
@@ -191,7 +303,7 @@ def edit_note(note_id):
         return redirect('/profile/')
 
 
-@app.route("/notes/delete/<id>/", methods=['GET', 'POST'])
+@bp.route("/notes/delete/<id>/", methods=['GET', 'POST'])
 @login_required
 def delete_note(id):
     '''
@@ -199,21 +311,11 @@ def delete_note(id):
     '''
     functions.delete_note_using_id(id)
     notes = functions.get_data_using_user_id(session['id'])
-    tags = []
-    if notes:
-        for note in notes:
-            tags_list = functions.get_tag_using_note_id(note[0])
-            temp_list = []
-            if tags_list:
-                for tag in tags_list:
-                    temp = functions.get_data_using_tag_id(tag)
-                    if temp is not None:
-                        temp_list.append(temp[0])
-            tags.append(', '.join(temp_list))
+    tags = get_tag_names(notes)
     return render_template('profile.html', delete=True, tags=tags, username=session['username'], notes=notes)
 
 
-@app.route("/tags/add/", methods=['GET', 'POST'])
+@bp.route("/tags/add/", methods=['GET', 'POST'])
 @login_required
 def add_tag():
     '''
@@ -227,17 +329,17 @@ def add_tag():
     return render_template('add_tag.html', form=form, username=session['username'])
 
 
-@app.route("/tags/")
+@bp.route("/tags/")
 @login_required
 def view_tag():
     '''
         App for viewing all available tags
     '''
-    tags = functions.get_all_tags(session['id'])
+    tags = functions.get_all_tags_with_count(session['id'])
     return render_template('edit_tag.html', tags=tags, username=session['username'])
 
 
-@app.route("/tags/view/<tag_id>")
+@bp.route("/tags/view/<tag_id>")
 @login_required
 def view_notes_using_tag(tag_id):
     '''
@@ -253,19 +355,49 @@ def view_notes_using_tag(tag_id):
     )
 
 
-@app.route("/tags/delete/<tag_id>/")
+@bp.route("/tags/filter/")
+@login_required
+def filter_notes_using_tags():
+    '''
+        App for viewing the notes matching a tag expression such as
+        "work and urgent and not done"
+    '''
+    expression = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * tag_filter.PAGE_SIZE
+    notes, count, error = [], 0, None
+    if expression:
+        try:
+            count, ids = tag_filter.filter_notes(session['id'], expression, offset, tag_filter.PAGE_SIZE)
+            notes = functions.get_notes_using_ids(ids, session['id'])
+        except ValueError as e:
+            error = str(e)
+    return render_template(
+        'filter_tag.html',
+        notes=notes,
+        count=count,
+        error=error,
+        expression=expression,
+        page=page,
+        offset=offset,
+        pages=(count + tag_filter.PAGE_SIZE - 1) // tag_filter.PAGE_SIZE,
+        username=session['username']
+    )
+
+
+@bp.route("/tags/delete/<tag_id>/")
 @login_required
 def delete_tag(tag_id):
     '''
         App for deleting a specific tag
     '''
     functions.delete_tag_using_id(tag_id)
-    tags = functions.get_all_tags(session['id'])
+    tags = functions.get_all_tags_with_count(session['id'])
     return render_template('edit_tag.html', tags=tags, delete=True, username=session['username'])
 
 
 # Custom Filter
-@app.template_filter()
+@bp.app_template_filter()
 def custom_date(date):
     '''
         Convert a datetime into custom format like: Sep 12,2017 19:07:32
@@ -274,21 +406,20 @@ def custom_date(date):
     return date.strftime('%b %d,%Y %H:%M:%S')
 
 
-@app.route("/profile/settings/")
+@bp.route("/profile/settings/")
 @login_required
 def profile_settings():
     '''
         App for getting profile settings for a user
     '''
     user_data = functions.get_user_data(session['id'])
-    notes_count = functions.get_number_of_notes(session['id'])
-    tag_count = functions.get_number_of_tags(session['id'])
+    notes_count, tag_count = user_data[0][-2:] if user_data else (0, 0)
     return render_template(
         'profile_settings.html',user_data=user_data,username=session['username'],notes_count=notes_count,tag_count=tag_count)
 
 
 
-@app.route("/profile/settings/change_email/", methods=['GET', 'POST'])
+@bp.route("/profile/settings/change_email/", methods=['GET', 'POST'])
 @login_required
 def change_email():
     '''
@@ -302,7 +433,7 @@ def change_email():
     return render_template('change_email.html', form=form, username=session['username'])
 
 
-@app.route("/profile/settings/change_password/", methods=['GET', 'POST'])
+@bp.route("/profile/settings/change_password/", methods=['GET', 'POST'])
 @login_required
 def change_password():
     '''
@@ -316,7 +447,8 @@ def change_password():
     return render_template('change_password.html', form=form, username=session['username'])
 
 
-@app.route('/background_process/')
+@bp.route('/background_process/')
+@rate_limit('background_process', rate=5, capacity=10)
 def background_process():
     '''
         App for handling AJAX request for searching notes
@@ -325,7 +457,11 @@ def background_process():
         notes = request.args.get('notes')
         if notes == '':
             return jsonify(result='')
-        results = functions.get_search_data(str(notes), session['id'])
+        results = cache.cached(
+            'search:%s:%s' % (session['id'], notes),
+            lambda: functions.get_search_data(str(notes), session['id']),
+            session['id']
+        )
         temp = ''
         for result in results:
             temp += "<h4><a href='/notes/" + str(result[0]) + "/'>" + result[1] + "</a></h4><br>"
@@ -334,7 +470,21 @@ def background_process():
         return str(e)
 
 
+@bp.route('/metrics/')
+def metrics():
+    '''
+        App for exporting counters shared by all workers
+    '''
+    return jsonify(
+        rate_limit_rejections=ratelimit.get_rejection_counters(),
+        cache=cache.get_stats(),
+        worker=dict(worker_stats, pid=os.getpid())
+    )
+
+
 class GetDataUsingUserID(Resource):
+    decorators = [rate_limit('api', rate=0.5, capacity=5)]
+
     def post(self):
         try:
             args = parser.parse_args()
@@ -343,16 +493,205 @@ class GetDataUsingUserID(Resource):
             user_id = functions.check_user_exists(username, password)
             if user_id:
                 functions.store_last_login(user_id)
+                if args['tags']:
+                    return get_notes_using_tag_expression(user_id, args)
                 return functions.get_rest_data_using_user_id(user_id)
             else:
                 return {'error': 'You cannot access this page, please check username and password'}
         except AttributeError:
             return {'error': 'Please specify username and password'}
 
+
+def get_notes_using_tag_expression(user_id, args):
+    '''
+        Returns the count and a page of the notes matching the tags
+        expression of an API call, numbered from its offset
+    '''
+    offset = max(args['offset'] or 0, 0)
+    limit = min(max(args['limit'] or 100, 1), 500)
+    try:
+        count, ids = tag_filter.filter_notes(user_id, args['tags'], offset, limit)
+    except ValueError as e:
+        return {'error': 'Invalid tags expression: %s' % e}
+    notes = functions.get_notes_using_ids(ids, user_id) or []
+    return {'count': count, 'notes': dict((offset + i, note) for i, note in enumerate(notes))}
+
 api.add_resource(GetDataUsingUserID, '/api/')
 parser.add_argument('username')
 parser.add_argument('password')
 
 
+class SyncNotes(Resource):
+    # Its own bucket: a client catching up pages through /api/sync/ back
+    # to back, which would exhaust the one of /api/ after five pages
+    decorators = [rate_limit('sync', rate=2, capacity=20)]
+
+    def post(self):
+        '''
+            Returns the notes, tags and deletions newer than the cursor the
+            client got from its previous call. Omit the cursor for a full sync.
+            When the database was restored since the cursor was handed out,
+            a full sync is returned with resync set: the client must drop
+            what it holds and replace it with the notes and tags that follow
+        '''
+        try:
+            args = sync_parser.parse_args()
+            username = args['username']
+            password = functions.generate_password_hash(args['password'])
+            user_id = functions.check_user_exists(username, password)
+            if user_id:
+                limit = min(max(args['limit'], 1), 500)
+                return functions.get_sync_changes(
+                    user_id, args['updated'], args['id'],
+                    args['tombstone_id'], args['tag_id'], limit, args['epoch']
+                )
+            else:
+                return {'error': 'You cannot access this page, please check username and password'}
+        except AttributeError:
+            return {'error': 'Please specify username and password'}
+
+api.add_resource(SyncNotes, '/api/sync/')
+sync_parser = parser.copy()
+sync_parser.add_argument('updated', default='')
+sync_parser.add_argument('id', type=int, default=0)
+sync_parser.add_argument('tag_id', type=int, default=0)
+sync_parser.add_argument('tombstone_id', type=int, default=0)
+sync_parser.add_argument('limit', type=int, default=100)
+sync_parser.add_argument('epoch', type=int, default=0)
+
+# Only for /api/, whose parser the sync one is copied from
+parser.add_argument('tags')
+parser.add_argument('offset', type=int, default=0)
+parser.add_argument('limit', type=int, default=100)
+
+
+def create_app():
+    '''
+        Builds the application. Schema setup and database pragmas run once
+        here; connections are opened lazily by each worker after the fork,
+        so this is safe to run in the gunicorn master with --preload
+    '''
+    started = time.time()
+    app = Flask(__name__)
+    app.secret_key = os.getenv('SECRET_KEY')
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_ATTACHMENT_SIZE', 32 * 1024 * 1024))
+    proxies = int(os.getenv('TRUSTED_PROXIES', 0))
+    if proxies:
+        # Only the addresses appended by our own proxies can be trusted
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+    functions.init_database(os.getenv('DATABASE', 'notes.db'))
+    app.register_blueprint(bp)
+    pagedown.init_app(app)
+    if os.getenv('WARM_UP', '').lower() in ('1', 'true', 'yes'):
+        warm_up(app)
+
+    @app.before_request
+    def start_timer():
+        if 'first_request_seconds' not in worker_stats:
+            g.request_started = time.time()
+
+    @app.after_request
+    def record_first_request(response):
+        if 'first_request_seconds' not in worker_stats and 'request_started' in g:
+            worker_stats['first_request_seconds'] = round(time.time() - g.request_started, 6)
+            app.logger.info('Worker %s served its first request in %.1f ms', os.getpid(), worker_stats['first_request_seconds'] * 1000)
+        return response
+
+    # Under gunicorn, post_worker_init in gunicorn.conf.py replaces
+    # startup_seconds with the worker's own time from fork to ready
+    worker_stats['app_build_seconds'] = worker_stats['startup_seconds'] = round(time.time() - started, 6)
+    app.logger.info('Application built in %.1f ms', worker_stats['app_build_seconds'] * 1000)
+    return app
+
+
+def warm_up(app):
+    '''
+        Compiles every Jinja template into the environment's cache and reads
+        the small per-user tables so their pages are in the OS page cache
+        before the first request arrives
+    '''
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    functions.warm_up()
+
+
+app = create_app()
+
+
+@click.group()
+def cli():
+    '''
+        Maintenance commands, run as: python manage.py <command>
+    '''
+
+
+@cli.command('backup')
+@click.argument('directory')
+@click.option('--pages', default=256, help='Pages copied per step, -1 copies everything in one step')
+@click.option('--throttle', default=0.05, help='Seconds to sleep between steps')
+@click.option('--compress/--no-compress', default=True, help='Gzip the snapshot')
+@click.option('--verify/--no-verify', default=True, help='Run an integrity check on the snapshot')
+def backup_command(directory, pages, throttle, compress, verify):
+    '''
+        Takes a snapshot of the live database into DIRECTORY
+    '''
+    report = backup.backup_database(functions.DATABASE_FILE, directory, pages, throttle, compress, verify)
+    click.echo(json.dumps(report, indent=2, sort_keys=True))
+
+
+@cli.command('verify')
+@click.argument('snapshot')
+def verify_command(snapshot):
+    '''
+        Checks the integrity of SNAPSHOT
+    '''
+    result = backup.verify_snapshot(snapshot)
+    click.echo(result)
+    if result != 'ok':
+        sys.exit(1)
+
+
+@cli.command('restore')
+@click.argument('source')
+@click.option('--at', default=None, help="Restore the newest snapshot taken at or before 'YYYY-mm-dd HH:MM:SS'")
+def restore_command(source, at):
+    '''
+        Restores the live database from SOURCE, a snapshot file or a
+        directory of snapshots
+    '''
+    snapshot = backup.find_snapshot(source, at) if os.path.isdir(source) else source
+    if snapshot is None:
+        click.echo('No snapshot found in %s' % source)
+        sys.exit(1)
+    report = backup.restore_database(snapshot, functions.DATABASE_FILE)
+    click.echo(json.dumps(report, indent=2, sort_keys=True))
+
+
+@cli.command('check-queries')
+def check_queries_command():
+    '''
+        Explains every statement of the data layer against a seeded database
+        and fails when one scans a large table without being allowlisted, or
+        when one of its writes does not take effect
+    '''
+    report, failures, missing, broken = query_plans.run()
+    click.echo(query_plans.format_report(report, failures, missing, broken))
+    if failures or missing or broken:
+        sys.exit(1)
+
+
+@cli.command('gc-attachments')
+@click.option('--grace', default=attachments.GRACE_SECONDS, help='Keep blobs unreferenced for less than this many seconds')
+def gc_attachments_command(grace):
+    '''
+        Deletes stored files no attachment points at any more
+    '''
+    removed, freed = attachments.collect_garbage(grace)
+    click.echo('Removed %d blobs, freed %d bytes' % (removed, freed))
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    if len(sys.argv) > 1:
+        cli()
+    else:
+        app.run(debug=True)
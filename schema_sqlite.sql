@@ -1,4 +1,4 @@
-CREATE TABLE `notes` (
+CREATE TABLE IF NOT EXISTS `notes` (
   `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
   `created` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
   `updated` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
@@ -10,12 +10,12 @@ CREATE TABLE `notes` (
   FOREIGN KEY(user_id) REFERENCES users(id)
 );
 
-CREATE TRIGGER `triggerDate` AFTER UPDATE ON `notes`
+CREATE TRIGGER IF NOT EXISTS `triggerDate` AFTER UPDATE ON `notes`
 BEGIN
    update `notes` SET `updated` = (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')) WHERE id = NEW.id;
 END;
 
-CREATE TABLE `users` (
+CREATE TABLE IF NOT EXISTS `users` (
   `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
   `registered_at` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
   `last_login` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
@@ -24,14 +24,175 @@ CREATE TABLE `users` (
   `email` VARCHAR(200)
 );
 
-CREATE TRIGGER `triggerUserLogin` AFTER UPDATE ON `users`
+CREATE TRIGGER IF NOT EXISTS `triggerUserLogin` AFTER UPDATE ON `users`
 BEGIN
    update `users` SET `last_login` = (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')) WHERE id = NEW.id;
 END;
 
-CREATE TABLE `tags` (
+CREATE TABLE IF NOT EXISTS `tags` (
   `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
   `tag` TEXT,
   `user_id` INTEGER,
   FOREIGN KEY(user_id) REFERENCES users(id)
 );
+
+-- Tag assignments, one row per (note, tag). `notes.tags` keeps the
+-- comma separated list for display; this table is what gets counted.
+CREATE TABLE IF NOT EXISTS `note_tags` (
+  `note_id` INTEGER NOT NULL,
+  `tag_id` INTEGER NOT NULL,
+  `user_id` INTEGER NOT NULL,
+  PRIMARY KEY(note_id, tag_id),
+  FOREIGN KEY(note_id) REFERENCES notes(id),
+  FOREIGN KEY(tag_id) REFERENCES tags(id)
+);
+
+CREATE INDEX IF NOT EXISTS `idx_note_tags_tag` ON `note_tags` (`tag_id`);
+
+-- Per-user and per-tag counters, kept up to date by the triggers below
+CREATE TABLE IF NOT EXISTS `user_stats` (
+  `user_id` INTEGER NOT NULL PRIMARY KEY,
+  `notes_count` INTEGER NOT NULL DEFAULT 0,
+  `tags_count` INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+CREATE TABLE IF NOT EXISTS `tag_stats` (
+  `tag_id` INTEGER NOT NULL PRIMARY KEY,
+  `user_id` INTEGER NOT NULL,
+  `notes_count` INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(tag_id) REFERENCES tags(id)
+);
+
+CREATE TRIGGER IF NOT EXISTS `triggerUserStatsUser` AFTER INSERT ON `users`
+BEGIN
+   INSERT OR IGNORE INTO `user_stats`(`user_id`) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerUserStatsNoteInsert` AFTER INSERT ON `notes`
+BEGIN
+   INSERT OR IGNORE INTO `user_stats`(`user_id`) VALUES (NEW.user_id);
+   UPDATE `user_stats` SET `notes_count` = `notes_count` + 1 WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerUserStatsNoteDelete` AFTER DELETE ON `notes`
+BEGIN
+   UPDATE `user_stats` SET `notes_count` = `notes_count` - 1 WHERE user_id = OLD.user_id;
+   DELETE FROM `note_tags` WHERE note_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerUserStatsTagInsert` AFTER INSERT ON `tags`
+BEGIN
+   INSERT OR IGNORE INTO `user_stats`(`user_id`) VALUES (NEW.user_id);
+   UPDATE `user_stats` SET `tags_count` = `tags_count` + 1 WHERE user_id = NEW.user_id;
+   INSERT OR IGNORE INTO `tag_stats`(`tag_id`, `user_id`) VALUES (NEW.id, NEW.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerUserStatsTagDelete` AFTER DELETE ON `tags`
+BEGIN
+   UPDATE `user_stats` SET `tags_count` = `tags_count` - 1 WHERE user_id = OLD.user_id;
+   DELETE FROM `note_tags` WHERE tag_id = OLD.id;
+   DELETE FROM `tag_stats` WHERE tag_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerTagStatsInsert` AFTER INSERT ON `note_tags`
+BEGIN
+   UPDATE `tag_stats` SET `notes_count` = `notes_count` + 1 WHERE tag_id = NEW.tag_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerTagStatsDelete` AFTER DELETE ON `note_tags`
+BEGIN
+   UPDATE `tag_stats` SET `notes_count` = `notes_count` - 1 WHERE tag_id = OLD.tag_id;
+END;
+
+-- Soft-delete records so sync clients can find out what was removed
+CREATE TABLE IF NOT EXISTS `tombstones` (
+  `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+  `deleted` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
+  `kind` VARCHAR(10) NOT NULL,
+  `record_id` INTEGER NOT NULL,
+  `user_id` INTEGER NOT NULL,
+  FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+CREATE INDEX IF NOT EXISTS `idx_tombstones_user` ON `tombstones` (`user_id`, `id`);
+
+-- Changes whenever the database is restored, which rewinds ids and
+-- tombstones behind the sync cursors clients hold
+CREATE TABLE IF NOT EXISTS `sync_epoch` (
+  `id` INTEGER NOT NULL PRIMARY KEY CHECK (id = 0),
+  `epoch` INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO `sync_epoch`(`id`, `epoch`) VALUES (0, 1);
+CREATE INDEX IF NOT EXISTS `idx_notes_user_updated` ON `notes` (`user_id`, `updated`, `id`);
+CREATE INDEX IF NOT EXISTS `idx_tags_user` ON `tags` (`user_id`);
+CREATE INDEX IF NOT EXISTS `idx_users_username` ON `users` (`username`);
+
+-- Uploaded files are stored once per content hash; refcount is the number
+-- of attachments pointing at a blob and is kept up to date by triggers
+CREATE TABLE IF NOT EXISTS `blobs` (
+  `hash` CHAR(64) NOT NULL PRIMARY KEY,
+  `size` INTEGER NOT NULL,
+  `refcount` INTEGER NOT NULL DEFAULT 0,
+  `updated` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'))
+);
+
+CREATE INDEX IF NOT EXISTS `idx_blobs_unreferenced` ON `blobs` (`refcount`, `updated`);
+
+CREATE TABLE IF NOT EXISTS `attachments` (
+  `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+  `created` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
+  `note_id` INTEGER NOT NULL,
+  `user_id` INTEGER NOT NULL,
+  `hash` CHAR(64) NOT NULL,
+  `filename` VARCHAR(255),
+  `content_type` VARCHAR(100),
+  FOREIGN KEY(note_id) REFERENCES notes(id),
+  FOREIGN KEY(user_id) REFERENCES users(id),
+  FOREIGN KEY(hash) REFERENCES blobs(hash)
+);
+
+CREATE INDEX IF NOT EXISTS `idx_attachments_note` ON `attachments` (`note_id`);
+
+CREATE TRIGGER IF NOT EXISTS `triggerBlobRefInsert` AFTER INSERT ON `attachments`
+BEGIN
+   UPDATE `blobs` SET `refcount` = `refcount` + 1, `updated` = (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')) WHERE hash = NEW.hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerBlobRefDelete` AFTER DELETE ON `attachments`
+BEGIN
+   UPDATE `blobs` SET `refcount` = `refcount` - 1, `updated` = (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')) WHERE hash = OLD.hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerAttachmentsNoteDelete` AFTER DELETE ON `notes`
+BEGIN
+   DELETE FROM `attachments` WHERE note_id = OLD.id;
+END;
+
+-- Notes of each (user, tag) as a bitmap over the user's note ordinals;
+-- tag_id 0 holds all of the user's notes. Built on first use, then
+-- updated by the note write paths
+CREATE TABLE IF NOT EXISTS `tag_bitmaps` (
+  `user_id` INTEGER NOT NULL,
+  `tag_id` INTEGER NOT NULL,
+  `bitmap` BLOB NOT NULL,
+  PRIMARY KEY(user_id, tag_id)
+);
+
+-- Numbers each user's notes from 0 in id order, so that bitmaps grow
+-- with the size of the account rather than with the largest note id
+CREATE TABLE IF NOT EXISTS `note_ordinals` (
+  `note_id` INTEGER NOT NULL PRIMARY KEY,
+  `user_id` INTEGER NOT NULL,
+  `ordinal` INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS `idx_note_ordinals_user` ON `note_ordinals` (`user_id`, `ordinal`);
+
+CREATE TRIGGER IF NOT EXISTS `triggerNoteOrdinalsNoteDelete` AFTER DELETE ON `notes`
+BEGIN
+   DELETE FROM `note_ordinals` WHERE note_id = OLD.id;
+END;
+
+CREATE INDEX IF NOT EXISTS `idx_note_tags_user` ON `note_tags` (`user_id`, `tag_id`);
@@ -0,0 +1,103 @@
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+import utils.functions as functions
+
+
+ATTACHMENT_DIR = os.path.abspath(os.getenv('ATTACHMENT_DIR', 'attachments'))
+CHUNK_SIZE = 64 * 1024
+
+# Unreferenced blobs and abandoned uploads younger than this are kept
+GRACE_SECONDS = 3600
+
+
+def blob_path(digest):
+    '''
+        Returns where the blob with the given sha256 hex digest is stored
+    '''
+    return os.path.join(ATTACHMENT_DIR, digest[:2], digest[2:])
+
+
+def upload_directory():
+    path = os.path.join(ATTACHMENT_DIR, 'tmp')
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def store(stream):
+    '''
+        Copies stream to disk in chunks, hashing as it goes, and files it
+        under its content hash unless an identical blob is already stored.
+        Returns (digest, size)
+    '''
+    fd, temporary = tempfile.mkstemp(dir=upload_directory())
+    digest, size = hashlib.sha256(), 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+
+        # Reserve first: once the row is fresh the collector will not
+        # remove the file we are about to rely on
+        functions.reserve_blob(digest, size)
+        path = blob_path(digest)
+        if os.path.exists(path):
+            os.remove(temporary)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            os.rename(temporary, path)
+    except:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return digest, size
+
+
+def remove_blob(digest):
+    try:
+        os.remove(blob_path(digest))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def collect_garbage(grace_seconds=GRACE_SECONDS):
+    '''
+        Deletes blobs that no attachment has referenced for grace_seconds
+        and uploads abandoned for as long. Returns (blobs, bytes) removed
+    '''
+    removed, freed = 0, 0
+    for digest in functions.get_unreferenced_blobs(grace_seconds) or []:
+        path = blob_path(digest)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if functions.delete_unreferenced_blob(digest, grace_seconds, remove_blob):
+            removed += 1
+            freed += size
+
+    cutoff = time.time() - grace_seconds
+    directory = upload_directory()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.getmtime(path) < cutoff:
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return removed, freed
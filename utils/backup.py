@@ -0,0 +1,261 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import utils.cache as cache
+import utils.functions as functions
+
+SNAPSHOT_FORMAT = 'notes-%Y%m%d-%H%M%S.db'
+COMPRESSED_SUFFIX = '.gz'
+
+# After this many restarts caused by concurrent writes, the rest of the
+# backup is done in a single step
+MAX_RESTARTS = 3
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def probe_latency(conn):
+    '''
+        Times one small read and one write lock round trip on the live
+        database, which is what a request would wait for during a backup
+    '''
+    started = time.time()
+    conn.execute('SELECT * FROM notes ORDER BY id DESC LIMIT 1').fetchall()
+    read = time.time() - started
+    started = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('ROLLBACK')
+    write = time.time() - started
+    return read, write
+
+
+def summarize(samples):
+    '''
+        Returns the median and maximum of samples in milliseconds
+    '''
+    if not samples:
+        return {'p50_ms': None, 'max_ms': None}
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3)
+    }
+
+
+def copy_database(source, destination, pages=256, throttle=0.05, probe=None):
+    '''
+        Copies the live database source into the file destination with the
+        online backup API, pages at a time, sleeping throttle seconds between
+        steps so that writers can get in. Returns (steps, restarts) and
+        appends a (read, write) latency sample to probe after every step
+    '''
+    src = sqlite3.connect(source, timeout=5)
+    dst = sqlite3.connect(destination)
+    state = {'steps': 0, 'restarts': 0, 'remaining': None}
+
+    def progress(status, remaining, total):
+        state['steps'] += 1
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > MAX_RESTARTS:
+                raise TooManyRestarts()
+        state['remaining'] = remaining
+        if probe is not None:
+            probe.append(probe_latency(probe_conn))
+        time.sleep(throttle)
+
+    probe_conn = sqlite3.connect(source, timeout=5, isolation_level=None)
+    try:
+        if not hasattr(src, 'backup'):
+            # Python 2 has no backup API; VACUUM INTO takes a consistent copy
+            # inside a single read transaction instead
+            dst.close()
+            os.remove(destination)
+            src.execute('VACUUM INTO ?', (destination, ))
+            state['steps'] = 1
+        else:
+            try:
+                src.backup(dst, pages=pages, progress=progress)
+            except TooManyRestarts:
+                src.backup(dst, pages=-1)
+                state['steps'] += 1
+    finally:
+        probe_conn.close()
+        dst.close()
+        src.close()
+    return state['steps'], state['restarts']
+
+
+def check_integrity(path):
+    '''
+        Runs PRAGMA integrity_check on an uncompressed database file and
+        returns its result, 'ok' when the file is sound
+    '''
+    conn = sqlite3.connect(path)
+    try:
+        return '\n'.join(row[0] for row in conn.execute('PRAGMA integrity_check').fetchall())
+    finally:
+        conn.close()
+
+
+def backup_database(source, directory, pages=256, throttle=0.05, compress=True, verify=True):
+    '''
+        Writes a timestamped snapshot of source into directory without
+        stopping writers and returns a report of what it cost
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = time.strftime(SNAPSHOT_FORMAT)
+    if compress:
+        name += COMPRESSED_SUFFIX
+    snapshot = os.path.join(directory, name)
+    fd, temporary = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    packed = temporary + COMPRESSED_SUFFIX
+
+    try:
+        probe_conn = sqlite3.connect(source, timeout=5, isolation_level=None)
+        baseline = [probe_latency(probe_conn) for i in range(5)]
+        probe_conn.close()
+
+        started = time.time()
+        during = []
+        steps, restarts = copy_database(source, temporary, pages, throttle, during)
+        copy_seconds = time.time() - started
+
+        integrity = check_integrity(temporary) if verify else None
+        if integrity not in (None, 'ok'):
+            raise sqlite3.DatabaseError('Snapshot failed integrity check: ' + integrity)
+
+        if compress:
+            with open(temporary, 'rb') as raw, gzip.open(packed, 'wb') as out:
+                shutil.copyfileobj(raw, out)
+            os.rename(packed, snapshot)
+        else:
+            os.rename(temporary, snapshot)
+    finally:
+        for path in (temporary, packed):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        'snapshot': snapshot,
+        'size': os.path.getsize(snapshot),
+        'steps': steps,
+        'restarts': restarts,
+        'copy_seconds': round(copy_seconds, 3),
+        'total_seconds': round(time.time() - started, 3),
+        'integrity': integrity,
+        'read_latency': {
+            'baseline': summarize([sample[0] for sample in baseline]),
+            'during': summarize([sample[0] for sample in during])
+        },
+        'write_latency': {
+            'baseline': summarize([sample[1] for sample in baseline]),
+            'during': summarize([sample[1] for sample in during])
+        }
+    }
+
+
+def snapshot_time(name):
+    '''
+        Returns the struct_time encoded in a snapshot file name, or None
+    '''
+    name = os.path.basename(name)
+    if name.endswith(COMPRESSED_SUFFIX):
+        name = name[:-len(COMPRESSED_SUFFIX)]
+    try:
+        return time.strptime(name, SNAPSHOT_FORMAT)
+    except ValueError:
+        return None
+
+
+def find_snapshot(directory, at=None):
+    '''
+        Returns the newest snapshot in directory taken at or before at,
+        a 'YYYY-mm-dd HH:MM:SS' string, or the newest one when at is None
+    '''
+    limit = time.strptime(at, '%Y-%m-%d %H:%M:%S') if at else None
+    candidates = []
+    for name in os.listdir(directory):
+        taken = snapshot_time(name)
+        if taken is not None and (limit is None or taken <= limit):
+            candidates.append((taken, name))
+    if not candidates:
+        return None
+    return os.path.join(directory, max(candidates)[1])
+
+
+def unpack(snapshot, directory):
+    '''
+        Returns the path of an uncompressed copy of snapshot inside
+        directory, or snapshot itself when it is not compressed
+    '''
+    if not snapshot.endswith(COMPRESSED_SUFFIX):
+        return snapshot
+    path = os.path.join(directory, 'snapshot.db')
+    with gzip.open(snapshot, 'rb') as packed, open(path, 'wb') as raw:
+        shutil.copyfileobj(packed, raw)
+    return path
+
+
+def verify_snapshot(snapshot):
+    '''
+        Returns the integrity_check result of a (possibly compressed) snapshot
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        return check_integrity(unpack(snapshot, directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def read_sync_epoch(conn):
+    try:
+        return conn.execute('SELECT epoch FROM sync_epoch WHERE id=0').fetchone()[0]
+    except (sqlite3.OperationalError, TypeError):
+        # Databases from before sync epochs
+        return 0
+
+
+def restore_database(snapshot, destination):
+    '''
+        Replaces the contents of the live database destination with the
+        snapshot after verifying it, then clears the shared cache. The copy
+        goes through the backup API so open connections see the restored
+        data instead of a swapped file. The restored database is brought up
+        to the current schema and moved to a new sync epoch, so clients
+        holding cursors from before the restore sync from scratch
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        path = unpack(snapshot, directory)
+        integrity = check_integrity(path)
+        if integrity != 'ok':
+            raise sqlite3.DatabaseError('Snapshot failed integrity check: ' + integrity)
+        src = sqlite3.connect(path)
+        if not hasattr(src, 'backup'):
+            src.close()
+            raise RuntimeError('Restoring a live database needs Python 3.7 or newer')
+        dst = sqlite3.connect(destination, timeout=30)
+        started = time.time()
+        try:
+            epoch = read_sync_epoch(dst)
+            src.backup(dst)
+            functions.create_sqlite_tables(dst)
+            dst.execute('UPDATE sync_epoch SET epoch=? WHERE id=0', (max(epoch, read_sync_epoch(dst)) + 1, ))
+            dst.commit()
+        finally:
+            dst.close()
+            src.close()
+        # Nothing cached from the replaced data may be served again
+        cache.clear()
+        return {'snapshot': snapshot, 'seconds': round(time.time() - started, 3)}
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,70 @@
+import binascii
+
+
+# A bitmap is a Python int with bit n set when the note numbered n is in
+# the set, so and/or/not over whole tags are single integer operations.
+# It is stored as big-endian bytes.
+
+
+def decode(blob):
+    '''
+        Returns the bitmap stored in blob
+    '''
+    if not blob:
+        return 0
+    return int(binascii.hexlify(blob), 16)
+
+
+def encode(bitmap):
+    '''
+        Returns the bytes to store bitmap as
+    '''
+    if not bitmap:
+        return b''
+    digits = '%x' % bitmap
+    if len(digits) % 2:
+        digits = '0' + digits
+    return binascii.unhexlify(digits)
+
+
+def from_ids(ids):
+    '''
+        Returns the bitmap with the bits of ids set, in linear time
+    '''
+    ids = list(ids)
+    if not ids:
+        return 0
+    size = max(ids) // 8 + 1
+    data = bytearray(size)
+    for i in ids:
+        data[size - 1 - i // 8] |= 1 << (i % 8)
+    return decode(bytes(data))
+
+
+def set_bit(bitmap, i, present):
+    if present:
+        return bitmap | (1 << i)
+    return bitmap & ~(1 << i)
+
+
+def count(bitmap):
+    return bin(bitmap).count('1')
+
+
+def ids(bitmap, offset=0, limit=None):
+    '''
+        Returns the set bits of bitmap from the highest down, skipping
+        offset of them and returning at most limit
+    '''
+    digits = bin(bitmap)[2:] if bitmap > 0 else ''
+    top = len(digits) - 1
+    found, position = [], digits.find('1')
+    while position != -1:
+        if offset:
+            offset -= 1
+        else:
+            found.append(top - position)
+            if limit is not None and len(found) >= limit:
+                break
+        position = digits.find('1', position + 1)
+    return found
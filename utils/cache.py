@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+CACHE_FILE = os.getenv('CACHE_DB', 'cache.db')
+MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Entries older than this are ignored, bounding how long a value can
+# outlive an invalidation that could not be written
+MAX_AGE = int(os.getenv('CACHE_TTL', 3600))
+
+# Attempts at recording an invalidation before giving up on it
+INVALIDATE_ATTEMPTS = 3
+
+# Entries are only marked as used again after this many seconds, so
+# that hits rarely need the write lock
+TOUCH_AFTER = 60
+EVICT_BATCH = 64
+
+# Hit and miss counts are kept in process and added to the shared
+# totals every FLUSH_EVERY operations or FLUSH_SECONDS seconds
+FLUSH_EVERY = 100
+FLUSH_SECONDS = 5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS `entries` (
+  `key` TEXT NOT NULL PRIMARY KEY,
+  `user_id` INTEGER,
+  `note_id` INTEGER,
+  `value` TEXT NOT NULL,
+  `size` INTEGER NOT NULL,
+  `accessed` REAL NOT NULL,
+  `created` REAL NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS `idx_entries_user` ON `entries` (`user_id`, `note_id`);
+CREATE INDEX IF NOT EXISTS `idx_entries_note` ON `entries` (`note_id`);
+CREATE INDEX IF NOT EXISTS `idx_entries_accessed` ON `entries` (`accessed`);
+
+-- Bumped on every invalidation so values computed before it are not stored
+CREATE TABLE IF NOT EXISTS `generations` (
+  `user_id` INTEGER NOT NULL PRIMARY KEY,
+  `generation` INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS `stats` (
+  `name` TEXT NOT NULL PRIMARY KEY,
+  `value` INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO `stats`(`name`) VALUES ('hits'), ('misses'), ('evictions'), ('invalidations'), ('bytes'), ('clears');
+
+CREATE TRIGGER IF NOT EXISTS `triggerEntryInsert` AFTER INSERT ON `entries`
+BEGIN
+   UPDATE `stats` SET `value` = `value` + NEW.size WHERE name = 'bytes';
+END;
+
+CREATE TRIGGER IF NOT EXISTS `triggerEntryDelete` AFTER DELETE ON `entries`
+BEGIN
+   UPDATE `stats` SET `value` = `value` - OLD.size WHERE name = 'bytes';
+END;
+'''
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_counters = {'hits': 0, 'misses': 0, 'flushed': time.time()}
+_counters_lock = threading.Lock()
+
+
+def get_connection():
+    '''
+        Returns this thread's connection to the cache file shared by all
+        workers, opening a new one after a fork
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(CACHE_FILE, timeout=1, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.executescript(SCHEMA)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(entries)')]
+        if 'created' not in columns:
+            # Entries from before ages were kept count as expired
+            conn.execute('ALTER TABLE entries ADD COLUMN `created` REAL NOT NULL DEFAULT 0')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def count(name):
+    '''
+        Counts a hit or a miss, flushing the counts when enough piled up
+    '''
+    with _counters_lock:
+        _counters[name] += 1
+        pending = _counters['hits'] + _counters['misses']
+        if pending < FLUSH_EVERY and time.time() - _counters['flushed'] < FLUSH_SECONDS:
+            return
+    flush()
+
+
+def flush():
+    '''
+        Adds this process' hit and miss counts to the shared totals
+    '''
+    with _counters_lock:
+        hits, misses = _counters['hits'], _counters['misses']
+        _counters.update(hits=0, misses=0, flushed=time.time())
+    try:
+        conn = get_connection()
+        conn.execute("UPDATE stats SET value=value+? WHERE name='hits'", (hits, ))
+        conn.execute("UPDATE stats SET value=value+? WHERE name='misses'", (misses, ))
+    except sqlite3.Error:
+        pass
+
+
+def get(key):
+    '''
+        Returns the cached value for key, or None when it is missing or
+        older than MAX_AGE
+    '''
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT value, accessed, created FROM entries WHERE key=?', (key, )).fetchone()
+        now = time.time()
+        if row is None or now - row[2] > MAX_AGE:
+            count('misses')
+            return None
+        if now - row[1] > TOUCH_AFTER:
+            conn.execute('UPDATE entries SET accessed=? WHERE key=?', (now, key))
+        count('hits')
+        return json.loads(row[0])
+    except sqlite3.Error:
+        return None
+
+
+def generation(user_id):
+    '''
+        Returns the invalidation generation of a user, to be passed to put().
+        It also moves on when the whole cache is cleared
+    '''
+    try:
+        row = get_connection().execute(
+            "SELECT (SELECT generation FROM generations WHERE user_id=?), value FROM stats WHERE name='clears'", (user_id, )
+        ).fetchone()
+        return (row[0] or 0, row[1])
+    except sqlite3.Error:
+        return None
+
+
+def put(key, value, user_id, note_id=None, since=None):
+    '''
+        Stores value under key for user_id, and note_id when it depends on
+        a single note. When since, a generation(), is given the value is
+        dropped if the user's data was invalidated after it was read
+    '''
+    data = json.dumps(value)
+    try:
+        conn = get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if since is not None and generation(user_id) != since:
+                conn.execute('ROLLBACK')
+                return
+            conn.execute('DELETE FROM entries WHERE key=?', (key, ))
+            now = time.time()
+            conn.execute(
+                'INSERT INTO entries(key, user_id, note_id, value, size, accessed, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, user_id, note_id, data, len(data) + len(key), now, now)
+            )
+            evict(conn)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error:
+        pass
+
+
+def evict(conn):
+    '''
+        Drops the least recently used entries until the cache fits in MAX_BYTES
+    '''
+    while conn.execute("SELECT value FROM stats WHERE name='bytes'").fetchone()[0] > MAX_BYTES:
+        deleted = conn.execute(
+            'DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)', (EVICT_BATCH, )
+        ).rowcount
+        if deleted <= 0:
+            break
+        conn.execute("UPDATE stats SET value=value+? WHERE name='evictions'", (deleted, ))
+
+
+def invalidate(user_id, note_id=None):
+    '''
+        Drops everything cached for a user that does not belong to a single
+        note, plus every entry of note_id when given. A busy cache is
+        retried; if it stays busy the failure is logged and the entries
+        expire after MAX_AGE
+    '''
+    for attempt in range(INVALIDATE_ATTEMPTS):
+        try:
+            conn = get_connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR IGNORE INTO generations(user_id) VALUES (?)', (user_id, ))
+                conn.execute('UPDATE generations SET generation=generation+1 WHERE user_id=?', (user_id, ))
+                deleted = conn.execute(
+                    'DELETE FROM entries WHERE (user_id=? AND note_id IS NULL) OR note_id=?', (user_id, note_id)
+                ).rowcount
+                conn.execute("UPDATE stats SET value=value+? WHERE name='invalidations'", (deleted, ))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            return True
+        except sqlite3.Error as e:
+            error = e
+            time.sleep(0.05 * (attempt + 1))
+    logger.error('Could not invalidate the cache of user %s (note %s): %s', user_id, note_id, error)
+    return False
+
+
+def clear():
+    '''
+        Drops every entry and moves every generation on, so that values
+        computed before the call are not stored either. Used after the
+        database is restored, so it waits for the cache rather than give up
+    '''
+    conn = get_connection()
+    conn.execute('PRAGMA busy_timeout=30000')
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM entries')
+            conn.execute("UPDATE stats SET value=value+1 WHERE name='clears'")
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.execute('PRAGMA busy_timeout=1000')
+
+
+def cached(key, compute, user_id, note_id=None):
+    '''
+        Returns the cached value for key, computing and storing it on a miss
+    '''
+    value = get(key)
+    if value is None:
+        since = generation(user_id)
+        value = compute()
+        if value is not None and since is not None:
+            put(key, value, user_id, note_id, since)
+    return value
+
+
+def get_stats():
+    '''
+        Returns the shared cache counters and the hit rate
+    '''
+    flush()
+    try:
+        stats = dict(get_connection().execute('SELECT name, value FROM stats').fetchall())
+        stats['entries'] = get_connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+    except sqlite3.Error:
+        return {}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(float(stats['hits']) / lookups, 4) if lookups else None
+    return stats
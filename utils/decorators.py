@@ -1,5 +1,7 @@
 from functools import wraps
-from flask import redirect, session
+from flask import redirect, session, request, jsonify
+import utils.ratelimit as ratelimit
+import math
 
 
 def login_required(f):
@@ -13,3 +15,40 @@ def login_required(f):
         except KeyError:
             return redirect('/login/')
     return wrap
+
+
+def rate_limit(endpoint, rate, capacity, methods=None):
+    '''
+        Admits at most capacity requests in a burst and rate requests per
+        second afterwards, per client IP and per user. Users are identified
+        by their session, or by the username they are trying to log in with
+        together with the IP, so that nobody else can use up a user's
+        bucket. The IP is the connecting address; X-Forwarded-For is only
+        honoured through the ProxyFix set up by create_app. When methods is
+        given, requests with other methods are not limited
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrap(*args, **kwargs):
+            if methods and request.method not in methods:
+                return f(*args, **kwargs)
+            scopes = [('ip', request.remote_addr)]
+            if session.get('id'):
+                scopes.append(('user', 'id=%s' % session['id']))
+            else:
+                username = request.values.get('username')
+                data = request.get_json(silent=True)
+                if not username and isinstance(data, dict):
+                    username = data.get('username')
+                if username:
+                    scopes.append(('user', 'name=%s,ip=%s' % (username, request.remote_addr)))
+
+            allowed, retry_after = ratelimit.take(endpoint, scopes, rate, capacity)
+            if not allowed:
+                response = jsonify(error='Too many requests, please try again later')
+                response.status_code = 429
+                response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+                return response
+            return f(*args, **kwargs)
+        return wrap
+    return decorator
@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import TextField, PasswordField, SubmitField, SelectMultipleField, HiddenField
+from flask_wtf.file import FileField, FileRequired
 from flask_pagedown.fields import PageDownField
 from wtforms import validators
 
@@ -53,3 +54,9 @@ class ChangePasswordForm(FlaskForm):
     confirm_password = PasswordField('Confirm Password*', [validators.Required("Confirm \
       your password")])
     submit = SubmitField('Update Password')
+
+
+class AddAttachmentForm(FlaskForm):
+    attachment = FileField('Attach a file:', [FileRequired("Please choose \
+      a file")])
+    submit = SubmitField('Upload')
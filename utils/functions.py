@@ -1,30 +1,178 @@
 import os
 import hashlib
+import sqlite3
+import threading
 
+import utils.bitmaps as bitmaps
+import utils.cache as cache
 
-def get_database_connection():
+
+DATABASE_FILE = 'notes.db'
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema_sqlite.sql')
+JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+
+_initialized = False
+_local = threading.local()
+
+
+def init_database(sqlite_file=None):
     '''
-        Creates a connection between selected database
+        One time database setup: creates or upgrades the schema and sets
+        the persistent journal mode. The connection used here is closed so
+        that nothing is inherited by forked workers
     '''
-    import sqlite3
-    sqlite_file = 'notes.db'
-    file_exists = os.path.isfile(sqlite_file)
-    conn = sqlite3.connect(sqlite_file)
-    if not file_exists:
+    global DATABASE_FILE, _initialized
+    if sqlite_file is not None:
+        DATABASE_FILE = sqlite_file
+    _local.conn = None
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        conn.execute('PRAGMA journal_mode=' + JOURNAL_MODE)
         create_sqlite_tables(conn)
+    finally:
+        conn.close()
+    _initialized = True
+
+
+def get_database_connection():
+    '''
+        Returns the connection of the current thread, opening it on first
+        use in every process so connections are never shared across a fork
+    '''
+    if not _initialized:
+        init_database()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DATABASE_FILE, timeout=5)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    else:
+        # Drop anything a previous call left uncommitted after an error
+        conn.rollback()
     return conn
 
 
+def warm_up():
+    '''
+        Reads the small per-user tables and their indexes once so that
+        their pages are already cached when the first request comes in
+    '''
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        for table in ('users', 'tags', 'user_stats', 'tag_stats', 'note_tags'):
+            conn.execute('SELECT * FROM ' + table).fetchall()
+    finally:
+        conn.close()
+
+
 def create_sqlite_tables(conn):
     '''
-        Creates a sqlite table as specified in schema_sqlite.sql file
+        Creates a sqlite table as specified in schema_sqlite.sql file.
+        Every statement in the schema is idempotent, so this also upgrades
+        an existing database and backfills the stats tables when they are new
     '''
     cursor = conn.cursor()
-    with open('schema_sqlite.sql', 'r') as schema_file:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_stats'")
+    upgrading = cursor.fetchone() is None
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='note_ordinals'")
+    numbering = cursor.fetchone() is None
+    with open(SCHEMA_FILE, 'r') as schema_file:
         cursor.executescript(schema_file.read())
+    if upgrading:
+        backfill_stats_tables(conn)
+    if numbering:
+        # Bitmaps built before ordinals were indexed by note id
+        cursor.execute('DELETE FROM tag_bitmaps')
     conn.commit()
 
 
+def backfill_stats_tables(conn):
+    '''
+        Fills note_tags, user_stats and tag_stats from the existing rows,
+        after which the triggers keep them up to date
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT OR IGNORE INTO user_stats(user_id, notes_count, tags_count) '
+        'SELECT id, (SELECT COUNT(*) FROM notes WHERE user_id=users.id), '
+        '(SELECT COUNT(*) FROM tags WHERE user_id=users.id) FROM users'
+    )
+    cursor.execute('INSERT OR IGNORE INTO tag_stats(tag_id, user_id) SELECT id, user_id FROM tags')
+    cursor.execute("SELECT id, tags FROM notes WHERE tags IS NOT NULL AND tags != ''")
+    for note_id, tags in cursor.fetchall():
+        set_note_tags(cursor, note_id, tags)
+    cursor.close()
+
+
+def set_note_tags(cursor, note_id, tags):
+    '''
+        Replaces the tag assignments of a note with the comma separated
+        tag ids in tags. Only tags owned by the note's user are stored
+    '''
+    cursor.execute('DELETE FROM note_tags WHERE note_id=?', (note_id, ))
+    if not tags:
+        return
+    for tag_id in set(tags.split(',')):
+        cursor.execute(
+            'INSERT OR IGNORE INTO note_tags(note_id, tag_id, user_id) '
+            'SELECT notes.id, tags.id, tags.user_id FROM notes JOIN tags ON tags.user_id=notes.user_id '
+            'WHERE notes.id=? AND tags.id=?', (note_id, tag_id)
+        )
+
+
+def get_owner(cursor, table, record_id):
+    '''
+        Returns the user_id of a row in notes or tags
+    '''
+    cursor.execute('SELECT user_id FROM ' + table + ' WHERE id=?', (record_id, ))
+    result = cursor.fetchone()
+    if result:
+        return result[0]
+
+
+def get_note_tag_ids(cursor, note_id):
+    '''
+        Returns the ids of the tags assigned to a note
+    '''
+    cursor.execute('SELECT tag_id FROM note_tags WHERE note_id=?', (note_id, ))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_tag_bitmaps(cursor, user_id, note_id, added, removed):
+    '''
+        Sets the bit of note_id in the bitmaps of the added tag ids and
+        clears it in the removed ones, tag id 0 being all of the user's
+        notes. New notes are numbered after the user's last one. Users
+        whose bitmaps were never built are left alone, they are built from
+        note_tags on first use. Routes pass ids from URLs and forms, so
+        note_id may be a string
+    '''
+    note_id = int(note_id)
+    cursor.execute('SELECT 1 FROM tag_bitmaps WHERE user_id=? AND tag_id=0', (user_id, ))
+    if cursor.fetchone() is None:
+        return
+    cursor.execute('SELECT ordinal FROM note_ordinals WHERE note_id=?', (note_id, ))
+    row = cursor.fetchone()
+    if row is not None:
+        ordinal = row[0]
+    else:
+        cursor.execute('SELECT MAX(ordinal) FROM note_ordinals WHERE user_id=?', (user_id, ))
+        last = cursor.fetchone()[0]
+        ordinal = 0 if last is None else last + 1
+        cursor.execute('INSERT INTO note_ordinals(note_id, user_id, ordinal) VALUES (?, ?, ?)', (note_id, user_id, ordinal))
+
+    changes = [(tag_id, True) for tag_id in added] + [(tag_id, False) for tag_id in removed]
+    for tag_id, present in changes:
+        cursor.execute('SELECT bitmap FROM tag_bitmaps WHERE user_id=? AND tag_id=?', (user_id, tag_id))
+        row = cursor.fetchone()
+        bitmap = bitmaps.set_bit(bitmaps.decode(row[0]) if row else 0, ordinal, present)
+        cursor.execute(
+            'INSERT OR REPLACE INTO tag_bitmaps(user_id, tag_id, bitmap) VALUES (?, ?, ?)',
+            (user_id, tag_id, sqlite3.Binary(bitmaps.encode(bitmap)))
+        )
+
+
 def get_user_count():
     '''
         Checks whether a user exists with the specified username and password
@@ -101,12 +249,16 @@ def signup_user(username, password, email):
 
 def get_user_data(user_id):
     '''
-        Function for getting the data of a specific user using his user_id
+        Function for getting the data of a specific user using his user_id,
+        followed by the notes and tags counts precomputed in user_stats
     '''
     conn = get_database_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id=?', (str(user_id), ))
+        cursor.execute(
+            'SELECT users.*, COALESCE(user_stats.notes_count, 0), COALESCE(user_stats.tags_count, 0) '
+            'FROM users LEFT JOIN user_stats ON user_stats.user_id=users.id WHERE users.id=?', (str(user_id), )
+        )
         results = cursor.fetchall()
         cursor.close()
         if len(results) == 0:
@@ -148,21 +300,6 @@ def get_data_using_id(id):
         cursor.close()
 
 
-def get_number_of_notes(id):
-    '''
-        Function for retrieving number of notes stored by a specific user
-    '''
-    conn = get_database_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(note) FROM notes WHERE user_id=' + str(id))
-        results = cursor.fetchone()[0]
-        cursor.close()
-        return results
-    except:
-        cursor.close()
-
-
 def get_data():
     '''
         Function for getting data of all notes
@@ -186,8 +323,12 @@ def add_note(note_title, note, note_markdown, tags, user_id):
     try:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO notes(note_title, note, note_markdown, tags, user_id) VALUES (?, ?, ?, ?, ?)", (note_title, note, note_markdown, tags, user_id))
+        note_id = cursor.lastrowid
+        set_note_tags(cursor, note_id, tags)
+        update_tag_bitmaps(cursor, user_id, note_id, [0] + get_note_tag_ids(cursor, note_id), [])
         conn.commit()
         cursor.close()
+        cache.invalidate(user_id)
         return
     except:
         cursor.close()
@@ -202,8 +343,14 @@ def edit_note(note_title, note, note_markdown, tags, note_id):
         cursor = conn.cursor()
         # print("UPDATE notes SET note_title=?, note=?, note_markdown=?, tags=? WHERE id=?", (note_title, note, note_markdown, tags, note_id))
         cursor.execute("UPDATE notes SET note_title=?, note=?, note_markdown=?, tags=? WHERE id=?", (note_title, note, note_markdown, tags, note_id))
+        old_tags = set(get_note_tag_ids(cursor, note_id))
+        set_note_tags(cursor, note_id, tags)
+        new_tags = set(get_note_tag_ids(cursor, note_id))
+        user_id = get_owner(cursor, 'notes', note_id)
+        update_tag_bitmaps(cursor, user_id, note_id, new_tags - old_tags, old_tags - new_tags)
         conn.commit()
         cursor.close()
+        cache.invalidate(user_id, note_id)
         return
     except:
         cursor.close()
@@ -216,9 +363,14 @@ def delete_note_using_id(id):
     conn = get_database_connection()
     try:
         cursor = conn.cursor()
+        user_id = get_owner(cursor, 'notes', id)
+        cursor.execute("INSERT INTO tombstones(kind, record_id, user_id) SELECT 'note', id, user_id FROM notes WHERE id=?", (id, ))
+        if user_id is not None:
+            update_tag_bitmaps(cursor, user_id, id, [], [0] + get_note_tag_ids(cursor, id))
         cursor.execute("DELETE FROM notes WHERE id=" + str(id))
         conn.commit()
         cursor.close()
+        cache.invalidate(user_id, id)
         return
     except:
         cursor.close()
@@ -242,6 +394,7 @@ def add_tag(tag, user_id):
         cursor.execute("INSERT INTO tags(tag, user_id) VALUES (?, ?)", (tag, user_id))
         conn.commit()
         cursor.close()
+        cache.invalidate(user_id)
         return
     except:
         cursor.close()
@@ -266,6 +419,29 @@ def get_all_tags(user_id):
         cursor.close()
 
 
+def get_all_tags_with_count(user_id):
+    '''
+        Function for getting all tags for a specific user along with the
+        number of notes tagged under each of them
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT tags.id, tags.tag, IFNULL(tag_stats.notes_count, 0) FROM tags '
+            'LEFT JOIN tag_stats ON tag_stats.tag_id=tags.id WHERE tags.user_id=?', (user_id, )
+        )
+        results = cursor.fetchall()
+        if len(results) > 0:
+            results = [(str(row[0]), row[1], row[2]) for row in results]
+        else:
+            results = None
+        cursor.close()
+        return results
+    except:
+        cursor.close()
+
+
 def get_data_using_tag_id(tag_id):
     '''
         Function for getting all tags for a specific user
@@ -320,29 +496,18 @@ def delete_tag_using_id(tag_id):
     conn = get_database_connection()
     try:
         cursor = conn.cursor()
+        user_id = get_owner(cursor, 'tags', tag_id)
+        cursor.execute("INSERT INTO tombstones(kind, record_id, user_id) SELECT 'tag', id, user_id FROM tags WHERE id=?", (tag_id, ))
         cursor.execute("DELETE FROM tags WHERE id=" + str(tag_id))
+        cursor.execute('DELETE FROM tag_bitmaps WHERE user_id=? AND tag_id=?', (user_id, tag_id))
         conn.commit()
         cursor.close()
+        cache.invalidate(user_id)
         return
     except:
         cursor.close()
 
 
-def get_number_of_tags(id):
-    '''
-        Function for retrieving number of tags stored by a specific user
-    '''
-    conn = get_database_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(tag) FROM tags WHERE user_id=' + str(id))
-        results = cursor.fetchone()[0]
-        cursor.close()
-        return results
-    except:
-        cursor.close()
-
-
 def get_notes_using_tag_id(tag_id, username):
     '''
         Function for retrieving notes stored by a specific tag
@@ -350,7 +515,10 @@ def get_notes_using_tag_id(tag_id, username):
     conn = get_database_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT id, note_title FROM notes WHERE user_id=? AND tags like ?', (username, '%' + tag_id + '%'))
+        cursor.execute(
+            'SELECT notes.id, notes.note_title FROM note_tags JOIN notes ON notes.id=note_tags.note_id '
+            'WHERE note_tags.user_id=? AND note_tags.tag_id=? ORDER BY notes.id', (username, tag_id)
+        )
         results = cursor.fetchall()
         cursor.close()
         return results
@@ -431,6 +599,306 @@ def get_rest_data_using_user_id(id):
         cursor.close()
 
 
+def get_sync_changes(user_id, updated='', note_id=0, tombstone_id=0, tag_id=0, limit=100, epoch=0):
+    '''
+        Function for getting what changed for a user since the client's
+        high-water marks: notes after (updated, note_id), tags after tag_id
+        and tombstones after tombstone_id, at most limit of each.
+        Notes updated in the current second are held back until the next
+        call, so a later write in the same second cannot fall behind the
+        returned cursor. A cursor from another sync epoch, i.e. from before
+        a restore, starts a full sync flagged with resync
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT epoch FROM sync_epoch WHERE id=0')
+        current = cursor.fetchone()[0]
+        resync = epoch != current and bool(updated or note_id or tombstone_id or tag_id)
+        if resync:
+            updated, note_id, tombstone_id, tag_id = '', 0, 0, 0
+        cursor.execute("SELECT strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')")
+        horizon = cursor.fetchone()[0]
+
+        cursor.execute(
+            'SELECT * FROM notes WHERE user_id=? AND (updated, id) > (?, ?) AND updated < ? '
+            'ORDER BY updated, id LIMIT ?', (user_id, updated, note_id, horizon, limit)
+        )
+        fieldnames = [f[0] for f in cursor.description]
+        notes = [dict(zip(fieldnames, row)) for row in cursor.fetchall()]
+
+        cursor.execute('SELECT id, tag FROM tags WHERE user_id=? AND id > ? ORDER BY id LIMIT ?', (user_id, tag_id, limit))
+        tags = [{'id': row[0], 'tag': row[1]} for row in cursor.fetchall()]
+
+        cursor.execute(
+            'SELECT id, deleted, kind, record_id FROM tombstones WHERE user_id=? AND id > ? ORDER BY id LIMIT ?',
+            (user_id, tombstone_id, limit)
+        )
+        deleted = [{'id': row[0], 'deleted': row[1], 'kind': row[2], 'record_id': row[3]} for row in cursor.fetchall()]
+        cursor.close()
+
+        if notes:
+            updated, note_id = notes[-1]['updated'], notes[-1]['id']
+        if tags:
+            tag_id = tags[-1]['id']
+        if deleted:
+            tombstone_id = deleted[-1]['id']
+        return {
+            'notes': notes,
+            'tags': tags,
+            'deleted': deleted,
+            'cursor': {
+                'updated': updated,
+                'id': note_id,
+                'tag_id': tag_id,
+                'tombstone_id': tombstone_id,
+                'epoch': current
+            },
+            'resync': resync,
+            'has_more': limit in (len(notes), len(tags), len(deleted))
+        }
+    except:
+        cursor.close()
+
+
+def reserve_blob(digest, size):
+    '''
+        Records a blob before its file is moved into place. Touching
+        updated keeps the garbage collector away from it while the upload
+        finishes
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR IGNORE INTO blobs(hash, size) VALUES (?, ?)', (digest, size))
+        cursor.execute("UPDATE blobs SET updated=(strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')) WHERE hash=?", (digest, ))
+        conn.commit()
+        cursor.close()
+        return
+    except:
+        cursor.close()
+
+
+def add_attachment(note_id, user_id, digest, filename, content_type):
+    '''
+        Function for attaching a stored blob to a note, returns the id
+        of the new attachment
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO attachments(note_id, user_id, hash, filename, content_type) VALUES (?, ?, ?, ?, ?)',
+            (note_id, user_id, digest, filename, content_type)
+        )
+        attachment_id = cursor.lastrowid
+        conn.commit()
+        cursor.close()
+        return attachment_id
+    except:
+        cursor.close()
+
+
+def get_attachment(attachment_id, user_id):
+    '''
+        Function for retrieving an attachment of a user along with the
+        size of its blob
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT attachments.id, attachments.note_id, attachments.hash, attachments.filename, '
+            'attachments.content_type, blobs.size FROM attachments JOIN blobs ON blobs.hash=attachments.hash '
+            'WHERE attachments.id=? AND attachments.user_id=?', (attachment_id, user_id)
+        )
+        results = cursor.fetchone()
+        cursor.close()
+        return results
+    except:
+        cursor.close()
+
+
+def get_attachments_using_note_id(note_id):
+    '''
+        Function for retrieving all attachments of a note
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT attachments.id, attachments.note_id, attachments.hash, attachments.filename, '
+            'attachments.content_type, blobs.size FROM attachments JOIN blobs ON blobs.hash=attachments.hash '
+            'WHERE attachments.note_id=? ORDER BY attachments.id', (note_id, )
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+    except:
+        cursor.close()
+
+
+def delete_attachment_using_id(attachment_id, user_id):
+    '''
+        Function for deleting an attachment of a user, the blob stays
+        until the garbage collector finds it unreferenced
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM attachments WHERE id=? AND user_id=?', (attachment_id, user_id))
+        conn.commit()
+        cursor.close()
+        return
+    except:
+        cursor.close()
+
+
+def get_unreferenced_blobs(grace_seconds):
+    '''
+        Function for listing blobs no attachment has pointed at for
+        grace_seconds
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT hash FROM blobs WHERE refcount=0 AND updated < strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime', ?)",
+            ('%+d seconds' % -grace_seconds, )
+        )
+        results = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return results
+    except:
+        cursor.close()
+
+
+def delete_unreferenced_blob(digest, grace_seconds, remove_file):
+    '''
+        Deletes a blob that is still unreferenced, calling remove_file
+        while the write lock is held so that a concurrent upload of the
+        same content either keeps the blob alive or stores the file again.
+        Returns True when the blob was deleted
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM blobs WHERE hash=? AND refcount=0 AND updated < strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime', ?)",
+            (digest, '%+d seconds' % -grace_seconds)
+        )
+        deleted = cursor.rowcount == 1
+        if deleted:
+            remove_file(digest)
+        conn.commit()
+        cursor.close()
+        return deleted
+    except:
+        conn.rollback()
+        cursor.close()
+        return False
+
+
+def build_tag_bitmaps(user_id):
+    '''
+        Function for (re)building every tag bitmap of a user from the
+        notes and note_tags tables, numbering the user's notes afresh
+    '''
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT id FROM notes WHERE user_id=? ORDER BY id', (user_id, ))
+        ordinals = dict((row[0], ordinal) for ordinal, row in enumerate(cursor.fetchall()))
+        assignments = {0: list(ordinals.values())}
+        cursor.execute('SELECT note_id, tag_id FROM note_tags WHERE user_id=?', (user_id, ))
+        for note_id, tag_id in cursor.fetchall():
+            assignments.setdefault(tag_id, []).append(ordinals[note_id])
+        cursor.execute('DELETE FROM note_ordinals WHERE user_id=?', (user_id, ))
+        cursor.executemany(
+            'INSERT INTO note_ordinals(note_id, user_id, ordinal) VALUES (?, ?, ?)',
+            [(note_id, user_id, ordinal) for note_id, ordinal in ordinals.items()]
+        )
+        cursor.execute('DELETE FROM tag_bitmaps WHERE user_id=?', (user_id, ))
+        cursor.executemany(
+            'INSERT INTO tag_bitmaps(user_id, tag_id, bitmap) VALUES (?, ?, ?)',
+            [(user_id, tag_id, sqlite3.Binary(bitmaps.encode(bitmaps.from_ids(ids)))) for tag_id, ids in assignments.items()]
+        )
+        conn.commit()
+        cursor.close()
+        return
+    except:
+        conn.rollback()
+        cursor.close()
+
+
+def get_tag_bitmaps(user_id, tag_ids):
+    '''
+        Function for retrieving {tag_id: bitmap} for the given tag ids of a
+        user plus tag id 0, building the user's bitmaps on first use.
+        Tags without notes are missing from the result
+    '''
+    tag_ids = [0] + [int(tag_id) for tag_id in tag_ids]
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        for attempt in range(2):
+            cursor.execute(
+                'SELECT tag_id, bitmap FROM tag_bitmaps WHERE user_id=? AND tag_id IN (%s)' % ', '.join('?' * len(tag_ids)),
+                [user_id] + tag_ids
+            )
+            results = dict((tag_id, bitmaps.decode(bitmap)) for tag_id, bitmap in cursor.fetchall())
+            if 0 in results:
+                break
+            build_tag_bitmaps(user_id)
+        cursor.close()
+        return results
+    except:
+        cursor.close()
+
+
+def get_note_ids_using_ordinals(ordinals, user_id):
+    '''
+        Function for translating note ordinals of a user, as used by the
+        tag bitmaps, into note ids, in the order of ordinals
+    '''
+    if not ordinals:
+        return []
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT ordinal, note_id FROM note_ordinals WHERE user_id=? AND ordinal IN (%s)' % ', '.join('?' * len(ordinals)),
+            [user_id] + list(ordinals)
+        )
+        ids = dict(cursor.fetchall())
+        cursor.close()
+        return [ids[ordinal] for ordinal in ordinals if ordinal in ids]
+    except:
+        cursor.close()
+
+
+def get_notes_using_ids(ids, user_id):
+    '''
+        Function for retrieving notes of a user by id, in the order of ids
+    '''
+    if not ids:
+        return []
+    conn = get_database_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT * FROM notes WHERE user_id=? AND id IN (%s)' % ', '.join('?' * len(ids)),
+            [user_id] + list(ids)
+        )
+        fieldnames = [f[0] for f in cursor.description]
+        notes = dict((row[0], dict(zip(fieldnames, row))) for row in cursor.fetchall())
+        cursor.close()
+        return [notes[note_id] for note_id in ids if note_id in notes]
+    except:
+        cursor.close()
+
+
 # if __name__ == '__main__':
     # print(get_rest_data_using_user_id(1))
     # print(get_data_using_id(1))
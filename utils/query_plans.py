@@ -0,0 +1,381 @@
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+import utils.bitmaps as bitmaps
+import utils.cache as cache
+import utils.functions as functions
+
+
+# Tables with at least this many rows in the seeded database must be
+# reached through an index
+LARGE_TABLE_ROWS = 1000
+
+SEED_USERS = 1000
+SEED_NOTES_PER_USER = 20
+SEED_TAGS_PER_USER = 5
+
+# Full scans that are intended, as (function, table): reason
+ALLOWED_SCANS = {
+    ('get_user_count', 'users'): 'counts every user for the homepage',
+    ('get_data', 'notes'): 'returns every note of every user',
+}
+
+# One call per data layer function, run in this order against the seed.
+# User 1 owns notes 1-20 and tags 1-5
+WORKLOAD = [
+    ('get_user_count', ()),
+    ('check_username', ('user1', )),
+    ('check_user_exists', ('user1', functions.generate_password_hash('password'))),
+    ('store_last_login', (1, )),
+    ('signup_user', ('someone', functions.generate_password_hash('password'), 'someone@example.com')),
+    ('get_user_data', (1, )),
+    ('get_data_using_user_id', (1, )),
+    ('get_data_using_id', (1, )),
+    ('get_data', ()),
+    ('build_tag_bitmaps', (1, )),
+    ('add_note', ('title', '<p>note</p>', 'note', '1,2', 1)),
+    # Routes pass ids from URLs and forms as strings
+    ('edit_note', ('edited', '<p>note</p>', 'note', '3,4', '1')),
+    ('get_tag_using_note_id', (1, )),
+    ('get_all_tags', (1, )),
+    ('get_all_tags_with_count', (1, )),
+    ('get_data_using_tag_id', (1, )),
+    ('get_tagname_using_tag_id', (1, )),
+    ('get_notes_using_tag_id', ('1', 1)),
+    ('get_search_data', ('note', 1)),
+    ('get_rest_data_using_user_id', (1, )),
+    ('get_sync_changes', (1, '2000-01-01 00:00:00', 0, 0, 0, 100)),
+    ('edit_email', ('user1@example.com', 1)),
+    ('edit_password', ('password', 1)),
+    ('add_tag', ('tag', 1)),
+    ('reserve_blob', ('0' * 64, 10)),
+    ('add_attachment', (1, 1, '0' * 64, 'file.txt', 'text/plain')),
+    ('get_attachment', (1, 1)),
+    ('get_attachments_using_note_id', (1, )),
+    ('delete_attachment_using_id', (1, 1)),
+    ('get_unreferenced_blobs', (0, )),
+    ('delete_unreferenced_blob', ('0' * 64, -1, lambda digest: None)),
+    ('get_tag_bitmaps', (1, [1, 2])),
+    ('get_note_ids_using_ordinals', ([3, 2, 1], 1)),
+    ('get_notes_using_ids', ([3, 2, 1], 1)),
+    ('delete_note_using_id', ('2', )),
+    ('delete_tag_using_id', ('2', )),
+]
+
+# What the workload's writes must have left behind, as
+# (function, sql, expected value). The data layer swallows errors, so a
+# write that fails would otherwise go unnoticed
+EFFECTS = [
+    ('edit_note', 'SELECT note_title FROM notes WHERE id=1', 'edited'),
+    ('edit_note', 'SELECT group_concat(tag_id) FROM (SELECT tag_id FROM note_tags WHERE note_id=1 ORDER BY tag_id)', '3,4'),
+    ('delete_note_using_id', 'SELECT COUNT(*) FROM notes WHERE id=2', 0),
+    ('delete_tag_using_id', 'SELECT COUNT(*) FROM tags WHERE id=2', 0),
+]
+
+SCAN_RE = re.compile(
+    r'^(SCAN|SEARCH)(?: TABLE)? (\w+)(?: AS \w+)?'
+    r'(?: USING (?:(?:COVERING )?INDEX (\w+)|INTEGER PRIMARY KEY))?(?: \((.*?)\))?'
+)
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WRITE_RE = re.compile(r'^\s*(?:(INSERT)(?: OR \w+)? INTO|(UPDATE)(?: OR \w+)?|(DELETE) FROM)\s+[`"]?(\w+)', re.I)
+TRIGGER_RE = re.compile(r'\b(INSERT|UPDATE|DELETE)\b.*?\bBEGIN\b(.*)\bEND\s*$', re.I | re.S)
+ROW_REFERENCE_RE = re.compile(r'\b(?:NEW|OLD)\.[`"]?\w+[`"]?', re.I)
+
+
+def seed_database(path):
+    '''
+        Creates a database at path with the current schema and enough rows
+        for the planner to prefer indexes wherever they exist
+    '''
+    functions.init_database(path)
+    conn = sqlite3.connect(path)
+    password = functions.generate_password_hash('password')
+    conn.executemany(
+        'INSERT INTO users(username, password, email) VALUES (?, ?, ?)',
+        [('user%d' % i, password, 'user%d@example.com' % i) for i in range(1, SEED_USERS + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO tags(tag, user_id) VALUES (?, ?)',
+        [('tag%d' % i, user_id) for user_id in range(1, SEED_USERS + 1) for i in range(SEED_TAGS_PER_USER)]
+    )
+    for user_id in range(1, SEED_USERS + 1):
+        first_tag = (user_id - 1) * SEED_TAGS_PER_USER + 1
+        for i in range(SEED_NOTES_PER_USER):
+            tags = '%d,%d' % (first_tag + i % SEED_TAGS_PER_USER, first_tag + (i + 1) % SEED_TAGS_PER_USER)
+            cursor = conn.execute(
+                'INSERT INTO notes(note_title, note, note_markdown, tags, user_id) VALUES (?, ?, ?, ?, ?)',
+                ('note %d' % i, '<p>note %d</p>' % i, 'note %d' % i, tags, user_id)
+            )
+            functions.set_note_tags(cursor, cursor.lastrowid, tags)
+    conn.execute("INSERT INTO note_ordinals(note_id, user_id, ordinal) SELECT id, user_id, (id - 1) %% %d FROM notes" % SEED_NOTES_PER_USER)
+    conn.execute("INSERT INTO tombstones(kind, record_id, user_id) SELECT 'note', id, user_id FROM notes")
+    conn.execute("INSERT INTO blobs(hash, size) SELECT printf('%064d', id), 100 FROM notes WHERE id % 2 = 0")
+    conn.execute(
+        "INSERT INTO attachments(note_id, user_id, hash, filename, content_type) "
+        "SELECT id, user_id, printf('%064d', id - id % 2), 'file.txt', 'text/plain' FROM notes"
+    )
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+def data_layer_functions():
+    '''
+        Returns the names of the functions in utils.functions that talk to
+        the database themselves
+    '''
+    names = []
+    for name in dir(functions):
+        value = getattr(functions, name)
+        code = getattr(value, '__code__', None)
+        if code is not None and name != 'get_database_connection' and 'get_database_connection' in code.co_names:
+            names.append(name)
+    return sorted(names)
+
+
+def collect_statements():
+    '''
+        Runs the workload and returns [(function, sql)] for every DML
+        statement the data layer executed
+    '''
+    conn = functions.get_database_connection()
+    statements = []
+    current = [None]
+
+    def trace(sql):
+        if re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', sql, re.I):
+            statements.append((current[0], sql))
+
+    conn.set_trace_callback(trace)
+    try:
+        for name, args in WORKLOAD:
+            current[0] = name
+            getattr(functions, name)(*args)
+    finally:
+        conn.set_trace_callback(None)
+    return statements
+
+
+def load_triggers(conn):
+    '''
+        Returns {(table, event): [(trigger, [statement])]} for the triggers
+        of the database, with NEW and OLD column references turned into
+        parameters so that the statements can be explained on their own
+    '''
+    triggers = {}
+    for name, table, sql in conn.execute("SELECT name, tbl_name, sql FROM sqlite_master WHERE type='trigger'"):
+        match = TRIGGER_RE.search(sql[sql.index(name) + len(name):])
+        if not match:
+            continue
+        statements = [ROW_REFERENCE_RE.sub('?', statement).strip() for statement in match.group(2).split(';')]
+        triggers.setdefault((table.lower(), match.group(1).upper()), []).append(
+            (name, [statement for statement in statements if statement])
+        )
+    return triggers
+
+
+def fired_statements(sql, triggers, seen=()):
+    '''
+        Returns [(trigger, statement)] for every trigger statement that
+        running sql fires, following triggers fired by triggers
+    '''
+    match = WRITE_RE.match(sql)
+    if not match:
+        return []
+    event = (match.group(1) or match.group(2) or match.group(3)).upper()
+    fired = []
+    for trigger, statements in triggers.get((match.group(4).lower(), event), []):
+        if trigger in seen:
+            continue
+        for statement in statements:
+            fired.append((trigger, statement))
+            fired.extend(fired_statements(statement, triggers, seen + (trigger, )))
+    return fired
+
+
+def load_stats(conn):
+    '''
+        Returns ({table: rows}, {index: [rows per equal prefix]}) from sqlite_stat1
+    '''
+    tables, indexes = {}, {}
+    for table, index, stat in conn.execute('SELECT tbl, idx, stat FROM sqlite_stat1'):
+        numbers = [int(number) for number in stat.split() if number.isdigit()]
+        tables[table] = numbers[0]
+        if index:
+            indexes[index] = numbers
+    return tables, indexes
+
+
+def estimate_rows(table, index, constraints, tables, indexes):
+    '''
+        Rough number of rows a plan step visits, using the same stat1
+        averages the planner uses
+    '''
+    rows = tables.get(table, 0)
+    if constraints is None or 'ANY(' in constraints:
+        return rows
+    equal = constraints.count('=?') - constraints.count('>=?') - constraints.count('<=?')
+    ranges = constraints.count('>') + constraints.count('<')
+    if 'rowid=?' in constraints and ranges == 0:
+        return 1
+    if index in indexes and equal > 0:
+        rows = indexes[index][min(equal, len(indexes[index]) - 1)]
+    return max(1, rows // (4 ** ranges))
+
+
+def explain(conn, sql):
+    '''
+        Returns the EXPLAIN QUERY PLAN detail lines of sql
+    '''
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    except sqlite3.ProgrammingError:
+        # Older Pythons trace statements with their placeholders
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')).fetchall()
+    return [row[-1] for row in rows]
+
+
+def check_plans(path):
+    '''
+        Explains every statement collected from the workload, and every
+        trigger statement it fires, against the seeded database at path. Returns (report, failures) where report is
+        a list of dicts and failures the ones scanning a large table
+    '''
+    conn = sqlite3.connect(path)
+    triggers = load_triggers(conn)
+    statements = []
+    for function, sql in collect_statements():
+        statements.append((function, sql, None))
+        for trigger, statement in fired_statements(sql, triggers):
+            statements.append((function, statement, trigger))
+    tables, indexes = load_stats(conn)
+    large = set(table for table, rows in tables.items() if rows >= LARGE_TABLE_ROWS)
+
+    report, failures, seen = [], [], set()
+    for function, sql, trigger in statements:
+        normalized = LITERAL_RE.sub('?', ' '.join(sql.split()))
+        if trigger:
+            normalized = '[%s] %s' % (trigger, normalized)
+        if (function, normalized) in seen:
+            continue
+        seen.add((function, normalized))
+
+        plan, cost, scans = explain(conn, sql), 0, []
+        for detail in plan:
+            match = SCAN_RE.match(detail)
+            if not match:
+                continue
+            kind, table, index, constraints = match.groups()
+            cost += estimate_rows(table, index, constraints if kind == 'SEARCH' else None, tables, indexes)
+            # A skip-scan (ANY) seeks once per distinct leading value, so
+            # on a large table it is no better than scanning the index
+            if table in large and (kind == 'SCAN' or 'ANY(' in (constraints or '')):
+                scans.append(table)
+
+        allowed = [table for table in scans if (function, table) in ALLOWED_SCANS]
+        entry = {
+            'function': function,
+            'sql': normalized,
+            'plan': plan,
+            'estimated_rows': cost,
+            'status': 'scan' if len(allowed) < len(scans) else 'allowed' if allowed else 'ok'
+        }
+        report.append(entry)
+        if entry['status'] == 'scan':
+            failures.append(entry)
+    conn.close()
+    return report, failures
+
+
+def check_effects():
+    '''
+        Returns a message for every write of the workload that did not
+        happen, and for tag bitmaps that no longer match a rebuild
+    '''
+    conn = functions.get_database_connection()
+    broken = []
+    for function, sql, expected in EFFECTS:
+        found = conn.execute(sql).fetchone()[0]
+        if found != expected:
+            broken.append('%s: %s returned %r instead of %r' % (function, sql, found, expected))
+
+    stored = tagged_notes(conn, 1)
+    functions.build_tag_bitmaps(1)
+    rebuilt = tagged_notes(conn, 1)
+    for tag_id in sorted(set(stored) | set(rebuilt)):
+        if stored.get(tag_id) != rebuilt.get(tag_id):
+            broken.append('tag bitmap %d of user 1 differs from a rebuild' % tag_id)
+    return broken
+
+
+def tagged_notes(conn, user_id):
+    '''
+        Returns {tag_id: set of note ids} from the stored bitmaps of a user
+    '''
+    notes = dict(conn.execute('SELECT ordinal, note_id FROM note_ordinals WHERE user_id=?', (user_id, )).fetchall())
+    tagged = {}
+    for tag_id, bitmap in conn.execute('SELECT tag_id, bitmap FROM tag_bitmaps WHERE user_id=?', (user_id, )):
+        ordinals = bitmaps.ids(bitmaps.decode(bitmap))
+        if ordinals:
+            tagged[tag_id] = set(notes.get(ordinal) for ordinal in ordinals)
+    return tagged
+
+
+def use_cache(path):
+    '''
+        Points utils.cache at the cache file path from this thread on
+    '''
+    conn = getattr(cache._local, 'conn', None)
+    if conn is not None:
+        conn.close()
+    cache._local.conn = None
+    cache.CACHE_FILE = path
+
+
+def run():
+    '''
+        Seeds a temporary database, checks every statement and returns
+        (report, failures, functions missing from the workload, broken
+        writes)
+    '''
+    directory = tempfile.mkdtemp()
+    previous = functions.DATABASE_FILE
+    previous_cache = cache.CACHE_FILE
+    # The workload's writes invalidate the cache; keep them away from the
+    # one the app is serving from
+    cache.flush()
+    use_cache(os.path.join(directory, 'cache.db'))
+    try:
+        path = os.path.join(directory, 'plans.db')
+        seed_database(path)
+        report, failures = check_plans(path)
+        broken = check_effects()
+    finally:
+        functions.init_database(previous)
+        use_cache(previous_cache)
+        shutil.rmtree(directory)
+    covered = set(name for name, args in WORKLOAD)
+    missing = [name for name in data_layer_functions() if name not in covered]
+    return report, failures, missing, broken
+
+
+def format_report(report, failures, missing, broken):
+    '''
+        Renders the result of run() as text
+    '''
+    lines = []
+    for entry in report:
+        lines.append('[%s] %s  (~%d rows)' % (entry['status'].upper(), entry['function'], entry['estimated_rows']))
+        lines.append('    ' + entry['sql'])
+        for detail in entry['plan']:
+            lines.append('      ' + detail)
+    lines.append('')
+    lines.append('%d statements, %d scanning a large table' % (len(report), len(failures)))
+    for name in missing:
+        lines.append('Not exercised by the workload: %s' % name)
+    for message in broken:
+        lines.append('Write did not take effect: %s' % message)
+    return '\n'.join(lines)
@@ -0,0 +1,111 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+
+
+RATELIMIT_FILE = os.getenv('RATELIMIT_DB', 'ratelimit.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS `buckets` (
+  `key` TEXT NOT NULL PRIMARY KEY,
+  `tokens` REAL NOT NULL,
+  `updated` REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS `rejections` (
+  `endpoint` TEXT NOT NULL,
+  `scope` TEXT NOT NULL,
+  `count` INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(endpoint, scope)
+);
+'''
+
+# Buckets idle for this long are full again and can be forgotten
+STALE_AFTER = 3600
+
+_local = threading.local()
+
+
+def get_connection():
+    '''
+        Returns this thread's connection to the limiter database shared by
+        all gunicorn workers, opening a new one after a fork
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(RATELIMIT_FILE, timeout=1, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def take(endpoint, scopes, rate, capacity):
+    '''
+        Takes one token from the bucket of every (scope, value) pair in
+        scopes for endpoint. Buckets hold at most capacity tokens and refill
+        at rate tokens per second. The request is admitted only when every
+        bucket has a token; returns (allowed, retry_after_seconds)
+    '''
+    now = time.time()
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            buckets = []
+            for scope, value in scopes:
+                key = '%s:%s:%s' % (endpoint, scope, value)
+                cursor.execute('SELECT tokens, updated FROM buckets WHERE key=?', (key, ))
+                row = cursor.fetchone()
+                if row is None:
+                    tokens = float(capacity)
+                else:
+                    tokens = min(float(capacity), row[0] + (now - row[1]) * rate)
+                buckets.append((scope, key, tokens))
+
+            empty = [bucket for bucket in buckets if bucket[2] < 1]
+            cost = 0 if empty else 1
+            for scope, key, tokens in buckets:
+                cursor.execute(
+                    'INSERT OR REPLACE INTO buckets(key, tokens, updated) VALUES (?, ?, ?)',
+                    (key, tokens - cost, now)
+                )
+            for scope, key, tokens in empty:
+                cursor.execute('INSERT OR IGNORE INTO rejections(endpoint, scope) VALUES (?, ?)', (endpoint, scope))
+                cursor.execute('UPDATE rejections SET count=count+1 WHERE endpoint=? AND scope=?', (endpoint, scope))
+            if random.random() < 0.001:
+                cursor.execute('DELETE FROM buckets WHERE updated < ?', (now - STALE_AFTER, ))
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.close()
+    except sqlite3.Error:
+        # Never turn a broken or busy limiter database into an outage
+        return True, 0
+
+    if not empty:
+        return True, 0
+    retry_after = max((1 - tokens) / rate for scope, key, tokens in empty)
+    return False, retry_after
+
+
+def get_rejection_counters():
+    '''
+        Returns the number of rejected requests as {endpoint: {scope: count}}
+    '''
+    counters = {}
+    try:
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT endpoint, scope, count FROM rejections')
+        for endpoint, scope, count in cursor.fetchall():
+            counters.setdefault(endpoint, {})[scope] = count
+        cursor.close()
+    except sqlite3.Error:
+        pass
+    return counters
@@ -0,0 +1,155 @@
+import re
+
+import utils.bitmaps as bitmaps
+import utils.functions as functions
+
+
+# Expressions combine tag names with and/or/not (also &, |, - and !) and
+# parentheses; names next to each other are and-ed, and names with spaces
+# can be quoted:  work and (urgent or "next week") and not done
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|(&|\band\b)|(\||\bor\b)|(-|!|\bnot\b)|"([^"]*)"|([^\s()&|!"]+))', re.I)
+
+MAX_EXPRESSION_LENGTH = 500
+PAGE_SIZE = 20
+
+
+def tokenize(expression):
+    '''
+        Returns the expression as a list of (kind, value) tokens
+    '''
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError('Unexpected "%s"' % expression[position:].strip())
+        opening, closing, conjunction, disjunction, negation, quoted, name = match.groups()
+        if opening:
+            tokens.append(('(', opening))
+        elif closing:
+            tokens.append((')', closing))
+        elif conjunction:
+            tokens.append(('and', conjunction))
+        elif disjunction:
+            tokens.append(('or', disjunction))
+        elif negation:
+            tokens.append(('not', negation))
+        else:
+            tokens.append(('tag', quoted if quoted is not None else name))
+        position = match.end()
+    return tokens
+
+
+class Parser(object):
+    '''
+        Recursive descent parser turning tokens into nested tuples:
+        ('or', a, b), ('and', a, b), ('not', a) and ('tag', name)
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            found = self.tokens[self.position][1] if self.peek() else 'end of expression'
+            raise ValueError('Expected %s but found "%s"' % (kind, found))
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError('Empty expression')
+        tree = self.disjunction()
+        if self.peek() is not None:
+            raise ValueError('Unexpected "%s"' % self.tokens[self.position][1])
+        return tree
+
+    def disjunction(self):
+        tree = self.conjunction()
+        while self.peek() == 'or':
+            self.take('or')
+            tree = ('or', tree, self.conjunction())
+        return tree
+
+    def conjunction(self):
+        tree = self.negation()
+        while self.peek() in ('and', 'not', 'tag', '('):
+            if self.peek() == 'and':
+                self.take('and')
+            tree = ('and', tree, self.negation())
+        return tree
+
+    def negation(self):
+        if self.peek() == 'not':
+            self.take('not')
+            return ('not', self.negation())
+        if self.peek() == '(':
+            self.take('(')
+            tree = self.disjunction()
+            self.take(')')
+            return tree
+        return ('tag', self.take('tag'))
+
+
+def parse(expression):
+    '''
+        Returns the syntax tree of a tag expression, raising ValueError
+        when it is malformed
+    '''
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError('Expression is too long')
+    return Parser(tokenize(expression)).parse()
+
+
+def tag_names(tree):
+    if tree[0] == 'tag':
+        return set([tree[1]])
+    names = set()
+    for child in tree[1:]:
+        names |= tag_names(child)
+    return names
+
+
+def evaluate(tree, tag_bitmaps, universe):
+    '''
+        Returns the bitmap of the notes matching tree, tag_bitmaps mapping
+        each name to its bitmap and universe being all of the user's notes
+    '''
+    kind = tree[0]
+    if kind == 'tag':
+        return tag_bitmaps.get(tree[1].lower(), 0)
+    if kind == 'not':
+        return universe & ~evaluate(tree[1], tag_bitmaps, universe)
+    left = evaluate(tree[1], tag_bitmaps, universe)
+    right = evaluate(tree[2], tag_bitmaps, universe)
+    return left & right if kind == 'and' else left | right
+
+
+def filter_notes(user_id, expression, offset=0, limit=PAGE_SIZE):
+    '''
+        Returns (count, note ids) of the notes of user_id matching the tag
+        expression, newest first, limit ids from offset. Names are matched
+        case-insensitively; unknown names match no notes
+    '''
+    tree = parse(expression)
+    names = set(name.lower() for name in tag_names(tree))
+    tag_ids = {}
+    for tag_id, tag in functions.get_all_tags(user_id) or []:
+        if tag.lower() in names:
+            tag_ids.setdefault(tag.lower(), []).append(int(tag_id))
+
+    stored = functions.get_tag_bitmaps(user_id, [tag_id for ids in tag_ids.values() for tag_id in ids]) or {}
+    tag_bitmaps = {}
+    for name, ids in tag_ids.items():
+        for tag_id in ids:
+            tag_bitmaps[name] = tag_bitmaps.get(name, 0) | stored.get(tag_id, 0)
+
+    matched = evaluate(tree, tag_bitmaps, stored.get(0, 0))
+    ordinals = bitmaps.ids(matched, offset, limit)
+    return bitmaps.count(matched), functions.get_note_ids_using_ordinals(ordinals, user_id) or []